@@ -14,52 +14,111 @@
 # GNU General Public License for more details.
 
 import argparse
+import atexit
 import subprocess
 import re
 import logging
+import mmap
+import os
+import shlex
+import sys
 import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
 from pathlib import Path
 
 # Global configuration variables
-MTK_CLIENT_CMD = 'python mtkclient/mtk.py'
+MTK_CLIENT_CMD = (sys.executable, 'mtkclient/mtk.py')
 
 # Default values if no arguments are supplied.
 MTK_CLIENT_ARGS = ''
+# Extra arguments split once, appended to every mtkclient command.
+MTK_CLIENT_ARGV = tuple(shlex.split(MTK_CLIENT_ARGS))
 # Extracted from MT6833P (opal).
 PSTORE_ADDRESS = '0x48090000'
 PSTORE_SIZE = '0xe0000'
 
+# Maps non-printable bytes to a space and the space itself to NUL, so runs of
+# printable characters can be split out with bytes.split() instead of a regex.
+# Splitting on whitespace collapses long non-printable stretches in C.
+ASCII_TABLE = bytes(
+    0 if b == 0x20 else b if 0x20 < b <= 0x7E else 0x20 for b in range(256)
+)
+# Dumps are scanned in slices of this size to keep peak memory bounded.
+SCAN_CHUNK_SIZE = 1 << 20
+# Write buffer for the extracted strings, coalesces the many small writes.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Pstore configuration as found in expdb, matched directly on the raw dump.
+# Only spaces may separate key and value, so a match stays in one printable run.
+PSTORE_CONFIG_RE = re.compile(
+    rb'pstore_(?P<key>addr|size)[: ]*0x(?P<value>[0-9a-fA-F]+)', re.IGNORECASE
+)
+
+# Prefix for every line of mtkclient output.
+MTK_CLIENT_PREFIX = b'[mtkclient] '
+
+# expdb dump shared by pstore detection and expdb extraction.
+_EXPDB_CACHE: Path | None = None
+
 def setup_logging() -> logging.Logger:
     """Configure logging"""
 
-    class PrefixFormatter(logging.Formatter):
-        def format(self, record):
-            record.msg = f'[mtklogs] {record.msg}'
-            return super().format(record)
-
     log = logging.getLogger('mtk-log-util')
     log.setLevel(logging.INFO)
 
     handler = logging.StreamHandler()
-    handler.setFormatter(PrefixFormatter('%(message)s'))
+    handler.setFormatter(logging.Formatter('[mtklogs] %(message)s'))
     log.addHandler(handler)
     return log
 
 
-def run_command(cmd: str) -> bool:
-    """Execute a shell command and stream output."""
+def prefix_output(chunk: bytes, last: bytes) -> bytes:
+    """Prefix every line of mtkclient output, including progress redraws."""
+
+    # Treat a CRLF as a single line break, like universal newlines did
+    output = chunk.replace(b'\r\n', b'\n')
+    output = output.replace(b'\r', b'\r' + MTK_CLIENT_PREFIX)
+    output = output.replace(b'\n', b'\n' + MTK_CLIENT_PREFIX)
+
+    # The previous chunk ended a line, unless it's a CRLF split across chunks
+    if last == b'\n' or (last == b'\r' and not chunk.startswith(b'\n')):
+        output = MTK_CLIENT_PREFIX + output
+
+    # Defer the prefix of the next line until it has output
+    if chunk.endswith((b'\n', b'\r')):
+        output = output[:-len(MTK_CLIENT_PREFIX)]
+
+    return output
+
 
-    logger.info('Executing command: %s', cmd)
+def run_command(args: tuple[str, ...]) -> bool:
+    """Execute a command and stream output."""
+
+    logger.info('Executing command: %s', shlex.join(args))
     try:
         with subprocess.Popen(
+            args=args,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            shell=True, text=True,
-            args=cmd, bufsize=1,
         ) as process:
             if process.stdout:
-                for line in iter(process.stdout.readline, ''):
-                    print(f'[mtkclient] {line.rstrip()}')
+                stdout = process.stdout
+                last = b'\n'
+
+                # Pass output through in chunks, prefixing on line boundaries
+                for chunk in iter(lambda: stdout.read1(65536), b''):
+                    sys.stdout.buffer.write(prefix_output(chunk, last))
+                    last = chunk[-1:]
+
+                    # Partial lines stay buffered until they're complete
+                    if last in {b'\n', b'\r'}:
+                        sys.stdout.buffer.flush()
+
+                # Terminate output that didn't end with a newline
+                if last != b'\n':
+                    sys.stdout.buffer.write(b'\n')
+                sys.stdout.buffer.flush()
 
             return_code = process.wait()
             if return_code != 0:
@@ -72,26 +131,68 @@ def run_command(cmd: str) -> bool:
         return False
 
 
+@contextmanager
+def map_file(filename: Path) -> Iterator[mmap.mmap | bytes]:
+    """Map a binary read-only, pages are read in on demand."""
+
+    with open(filename, 'rb') as fh:
+        # Empty files can't be mapped
+        if os.fstat(fh.fileno()).st_size == 0:
+            yield b''
+            return
+
+        # Dumps are scanned once from start to end, this largely overlaps
+        # with MADV_SEQUENTIAL below but also covers the file's read-ahead state
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Let the kernel read ahead while the mapping is being scanned
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+
+            yield data
+
+
+def iter_ascii_strings(data: mmap.mmap | bytes, min_length: int = 4) -> Iterator[bytes]:
+    """Yield printable ASCII runs from a binary, one chunk at a time."""
+
+    # Pieces of a run that spans chunk boundaries, joined once the run ends
+    carry: list[bytes] = []
+    for offset in range(0, len(data), SCAN_CHUNK_SIZE):
+        translated = data[offset:offset + SCAN_CHUNK_SIZE].translate(ASCII_TABLE)
+        tokens = translated.split()
+
+        if not translated.startswith(b' '):
+            carry.append(tokens.pop(0))
+            if not tokens and not translated.endswith(b' '):
+                continue
+        if carry:
+            tokens.insert(0, b''.join(carry))
+
+        carry = [] if translated.endswith(b' ') else [tokens.pop()]
+
+        for token in tokens:
+            if len(token) >= min_length:
+                yield token.replace(b'\x00', b' ')
+
+    run = b''.join(carry)
+    if len(run) >= min_length:
+        yield run.replace(b'\x00', b' ')
+
+
 def extract_ascii_strings(output_file: Path, filename: Path, min_length: int = 4) -> None:
     """Extract ASCII strings from a binary."""
 
     try:
-        with open(filename, 'rb') as fh:
-            data = fh.read()
-
-        # Regex to find printable ASCII strings
-        ascii_strings = re.findall(rb'[\x20-\x7E]{' + str(min_length).encode() + rb',}', data)
-        output_lines = [f'=== ASCII Strings from {filename} ===']
-
-        for string in ascii_strings:
-            try:
-                decoded = string.decode('ascii')
-                output_lines.append(decoded)
-            except UnicodeDecodeError:
-                continue
+        with map_file(filename) as data, \
+            open(output_file, 'wb', buffering=OUTPUT_BUFFER_SIZE) as out_fh:
+            out_fh.write(f'=== ASCII Strings from {filename} ==='.encode('utf-8'))
 
-        with open(output_file, 'w', encoding='utf-8') as out_fh:
-            out_fh.write('\n'.join(output_lines))
+            # Runs are printable ASCII already, so they're written out as is
+            for string in iter_ascii_strings(data, min_length):
+                out_fh.write(b'\n')
+                out_fh.write(string)
 
         logger.info('ASCII strings saved to %s', output_file)
     except OSError as error:
@@ -102,80 +203,115 @@ def extract_with_mtkclient(extraction_type: str, output_filename: str,
     address: str | None = None, size: str | None = None, da: bool = True) -> bool:
     """Generic wrapper for mtkclient."""
 
-    cmd : str
+    args = MTK_CLIENT_CMD
 
     if extraction_type == 'expdb':
-        cmd =  f'{MTK_CLIENT_CMD} r expdb {output_filename} {MTK_CLIENT_ARGS}'
+        args += ('r', 'expdb', output_filename)
     elif extraction_type == 'pstore':
-        cmd =  f'{MTK_CLIENT_CMD} {'da' if da else ''} peek {address} {size} '
-        cmd += f'--filename {output_filename} {MTK_CLIENT_ARGS}'
+        if da:
+            args += ('da',)
+        args += ('peek', str(address), str(size), '--filename', output_filename)
 
-    return run_command(cmd)
+    return run_command(args + MTK_CLIENT_ARGV)
 
 
-def detect_pstore_addr() -> tuple[str, str]:
-    """Auto-detect pstore configuration from expdb partition."""
+def is_dump_written(filename: Path) -> bool:
+    """Check that mtkclient actually wrote data into a dump."""
+
+    try:
+        if filename.stat().st_size > 0:
+            return True
+    except OSError:
+        pass
 
-    def _find_pstore_config_in_data(data: bytes) -> tuple[str | None, str | None]:
-        """Search for pstore configuration in binary data."""
+    logger.error('mtkclient did not write any data to %s', filename)
+    return False
 
-        ascii_strings = re.findall(rb'[\x20-\x7E]{4,}', data)
-        pstore_addr: str | None = None
-        pstore_size: str | None = None
 
-        for string in ascii_strings:
-            try:
-                decoded = string.decode('ascii')
+def get_expdb_dump() -> Path | None:
+    """Extract expdb partition once, later calls reuse the dump."""
 
-                # Look for individual patterns
-                addr_match = re.search(r'pstore_addr[:\s]*0x([0-9a-fA-F]+)', decoded, re.IGNORECASE)
-                if addr_match:
-                    pstore_addr = f'0x{addr_match.group(1)}'
-                    logger.info('Found pstore_addr: %s', pstore_addr)
+    global _EXPDB_CACHE  # pylint: disable=global-statement
 
-                size_match = re.search(r'pstore_size[:\s]*0x([0-9a-fA-F]+)', decoded, re.IGNORECASE)
-                if size_match:
-                    pstore_size = f'0x{size_match.group(1)}'
-                    logger.info('Found pstore_size: %s', pstore_size)
+    if _EXPDB_CACHE is not None:
+        logger.info('Reusing previously extracted expdb partition')
+        return _EXPDB_CACHE
+
+    with tempfile.NamedTemporaryFile(prefix='expdb-', suffix='.bin', delete=False) as tmp:
+        raw_expdb = Path(tmp.name)
+
+    # Registered up front so an interrupted extraction doesn't leave the dump behind
+    atexit.register(raw_expdb.unlink, missing_ok=True)
+
+    if not extract_with_mtkclient('expdb', str(raw_expdb)) or not is_dump_written(raw_expdb):
+        raw_expdb.unlink(missing_ok=True)
+        return None
+
+    _EXPDB_CACHE = raw_expdb
+    return raw_expdb
 
-                if pstore_addr and pstore_size:
-                    break
-            except UnicodeDecodeError:
-                continue
 
-        return pstore_addr, pstore_size
+def find_pstore_config(data: mmap.mmap | bytes) -> tuple[str | None, str | None]:
+    """Search for pstore configuration in binary data."""
 
-    with tempfile.TemporaryDirectory() as tmp:
-        raw_expdb_filename = f"{tmp}/expdb.bin"
-        logger.info('Extracting expdb partition to detect pstore configuration...')
+    config: dict[bytes, bytes] = {}
 
-        if not extract_with_mtkclient('expdb', raw_expdb_filename):
-            logger.error('Failed to extract expdb for pstore detection')
-            return PSTORE_ADDRESS, PSTORE_SIZE
+    # Go in file order, a later match replaces an earlier one for the same
+    # key until both keys have been seen
+    for match in PSTORE_CONFIG_RE.finditer(data):
+        config[match.group('key').lower()] = match.group('value')
+        if len(config) == 2:
+            break
 
-        try:
-            with open(raw_expdb_filename, 'rb') as fh:
-                data = fh.read()
+    pstore_addr: str | None = None
+    pstore_size: str | None = None
 
-            pstore_addr, pstore_size = _find_pstore_config_in_data(data)
+    if b'addr' in config:
+        pstore_addr = '0x' + config[b'addr'].decode('ascii')
+    if b'size' in config:
+        pstore_size = '0x' + config[b'size'].decode('ascii')
 
-            # Handle partial matches with fallbacks
-            if pstore_addr and pstore_size:
-                logger.info('Successfully detected pstore configuration from expdb')
-                return pstore_addr, pstore_size
-            if pstore_addr:
-                logger.info('Found address but missing size, using default size')
-                return pstore_addr, PSTORE_SIZE
-            if pstore_size:
-                logger.info('Found size but missing address, using default address')
-                return PSTORE_ADDRESS, pstore_size
+    if pstore_addr and pstore_size:
+        logger.info('Found pstore_addr: %s, pstore_size: %s', pstore_addr, pstore_size)
+    elif pstore_addr:
+        logger.info('Found pstore_addr: %s', pstore_addr)
+    elif pstore_size:
+        logger.info('Found pstore_size: %s', pstore_size)
 
-            logger.info('No pstore configuration found, using defaults')
-            return PSTORE_ADDRESS, PSTORE_SIZE
+    return pstore_addr, pstore_size
 
-        except OSError as error:
-            logger.error('Error reading expdb file for pstore detection: %s', error)
-            return PSTORE_ADDRESS, PSTORE_SIZE
+
+def detect_pstore_addr() -> tuple[str, str]:
+    """Auto-detect pstore configuration from expdb partition."""
+
+    logger.info('Extracting expdb partition to detect pstore configuration...')
+    raw_expdb = get_expdb_dump()
+
+    if raw_expdb is None:
+        logger.error('Failed to extract expdb for pstore detection')
+        return PSTORE_ADDRESS, PSTORE_SIZE
+
+    try:
+        with map_file(raw_expdb) as data:
+            pstore_addr, pstore_size = find_pstore_config(data)
+
+        # Handle partial matches with fallbacks
+        if pstore_addr and pstore_size:
+            logger.info('Successfully detected pstore configuration from expdb')
+            return pstore_addr, pstore_size
+        if pstore_addr:
+            logger.info('Found address but missing size, using default size')
+            return pstore_addr, PSTORE_SIZE
+        if pstore_size:
+            logger.info('Found size but missing address, using default address')
+            return PSTORE_ADDRESS, pstore_size
+
+        logger.info('No pstore configuration found, using defaults')
+        return PSTORE_ADDRESS, PSTORE_SIZE
+
+    except OSError as error:
+        logger.error('Error reading expdb file for pstore detection: %s', error)
+        return PSTORE_ADDRESS, PSTORE_SIZE
 
 
 def resolve_pstore_params(pstore_address: str | None, pstore_size: str | None,
@@ -197,13 +333,12 @@ def resolve_pstore_params(pstore_address: str | None, pstore_size: str | None,
 def extract_expdb(output_file: Path) -> bool:
     """Extract and analyze expdb partition."""
 
-    with tempfile.TemporaryDirectory() as tmp:
-        raw_expdb_filename = f"{tmp}/expdb.bin"
-        logger.info('Extracting expdb partition...')
+    logger.info('Extracting expdb partition...')
+    raw_expdb = get_expdb_dump()
 
-        if extract_with_mtkclient('expdb', raw_expdb_filename):
-            extract_ascii_strings(filename=Path(raw_expdb_filename), output_file=output_file)
-            return True
+    if raw_expdb is not None:
+        extract_ascii_strings(filename=raw_expdb, output_file=output_file)
+        return True
 
     logger.error('Failed to extract expdb partition')
     return False
@@ -215,12 +350,16 @@ def extract_pstore(output_file: Path, pstore_address: str | None = None,
 
     address, size = resolve_pstore_params(pstore_address, pstore_size, auto_detect)
 
-    with tempfile.TemporaryDirectory() as tmp:
-        raw_pstore_filename = f"{tmp}/pstore.bin"
+    with tempfile.NamedTemporaryFile(prefix='pstore-', suffix='.bin', delete=False) as tmp:
+        raw_pstore = Path(tmp.name)
 
-        if extract_with_mtkclient('pstore', raw_pstore_filename, address, size, da):
-            extract_ascii_strings(filename=Path(raw_pstore_filename), output_file=output_file)
+    try:
+        if extract_with_mtkclient('pstore', str(raw_pstore), address, size, da) \
+            and is_dump_written(raw_pstore):
+            extract_ascii_strings(filename=raw_pstore, output_file=output_file)
             return True
+    finally:
+        raw_pstore.unlink(missing_ok=True)
 
     logger.error('Failed to extract pstore from memory')
     return False